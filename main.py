@@ -1,11 +1,20 @@
 import os
+import re
+import sys
+import atexit
+import asyncio
 import requests
 import traceback
-from datetime import datetime, timedelta
+import httplib2
+import google_auth_httplib2
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from operator import itemgetter
 from typing import List, Optional
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from librus_apix.client import new_client, Client
@@ -13,21 +22,52 @@ from librus_apix.schedule import get_schedule
 from librus_apix.homework import get_homework, homework_detail, Homework
 from tenacity import retry, stop_after_attempt, wait_exponential
 
+load_dotenv()
+
+# Buforowany logger - jedna operacja write() zamiast syscalla na każdą linię
+class _Logger:
+    def __init__(self):
+        self._buffer = []
+
+    def log(self, message: str):
+        current_time = datetime.now().strftime("[%H:%M:%S] ")
+        self._buffer.append(f"{current_time}{message}\n")
+
+    def flush(self):
+        if self._buffer:
+            sys.stdout.write(''.join(self._buffer))
+            sys.stdout.flush()
+            self._buffer.clear()
+
+
+_logger = _Logger()
+atexit.register(_logger.flush)
+
+
 # Funkcja do formatowania logów
 def log_message(message: str):
-    current_time = datetime.now().strftime("[%H:%M:%S] ")
-    print(f"{current_time}{message}")
+    _logger.log(message)
 
 # Constants
 SCOPES = ['https://www.googleapis.com/auth/tasks']
 TASK_LIST_NAME = "Wydarzenia Librus"
 TEST_KEYWORDS = ["sprawdzian", "kartkówka"]
+_KEYWORD_RE = re.compile("|".join(map(re.escape, TEST_KEYWORDS)), re.IGNORECASE)
+
+# Wspólna sesja HTTP - ponowne użycie połączenia zamiast nowego TLS przy każdym żądaniu
+_session = requests.Session()
+_session.headers['User-Agent'] = 'librus-google-task-sync/1.0'
+_session.mount('https://', HTTPAdapter(
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+))
 
 
 class GoogleTasksManager:
     def __init__(self):
         self.service = self._get_google_tasks_service()
         self.task_list_id = self._get_or_create_task_list()
+        self._existing = None
 
     def _get_google_tasks_service(self) -> any:
         """Initialize and return Google Tasks service with proper authentication."""
@@ -44,11 +84,17 @@ class GoogleTasksManager:
         if not creds or not creds.valid:
             creds = self._refresh_or_get_new_credentials(creds, credentials_path, token_path)
 
-        return build('tasks', 'v1', credentials=creds)
+        http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(cache=None))
+        return build('tasks', 'v1', http=http, cache_discovery=False, static_discovery=True)
 
     def _refresh_or_get_new_credentials(self, creds: Optional[Credentials], credentials_path: str, token_path: str) -> Credentials:
         """Refresh existing credentials or get new ones."""
-        if creds and creds.expired and creds.refresh_token:
+        old_json = creds.to_json() if creds else None
+
+        needs_refresh = creds and creds.refresh_token and (
+            creds.expired or (creds.expiry and creds.expiry - datetime.utcnow() < timedelta(minutes=5))
+        )
+        if needs_refresh:
             try:
                 creds.refresh(Request())
                 log_message("Token został odświeżony automatycznie.")
@@ -59,6 +105,9 @@ class GoogleTasksManager:
                 creds = None
 
         if not creds or not creds.valid:
+            # Wolny import potrzebny tylko przy pełnym logowaniu OAuth
+            from google_auth_oauthlib.flow import InstalledAppFlow
+
             flow = InstalledAppFlow.from_client_secrets_file(
                 credentials_path,
                 SCOPES,
@@ -72,135 +121,188 @@ class GoogleTasksManager:
             creds = flow.credentials
             log_message("Nowy token został uzyskany.")
 
-        with open(token_path, 'w') as token:
-            token.write(creds.to_json())
+        # Zapisuj token na dysk tylko jeśli faktycznie się zmienił
+        if creds.to_json() != old_json:
+            with open(token_path, 'w') as token:
+                token.write(creds.to_json())
 
         return creds
 
     def _get_or_create_task_list(self) -> str:
         """Get existing task list ID or create a new one."""
-        task_lists = self.service.tasklists().list().execute().get('items', [])
+        task_lists = self.service.tasklists().list().execute(num_retries=3).get('items', [])
         for task_list in task_lists:
             if task_list['title'] == TASK_LIST_NAME:
                 return task_list['id']
 
-        new_list = self.service.tasklists().insert(body={'title': TASK_LIST_NAME}).execute()
+        new_list = self.service.tasklists().insert(body={'title': TASK_LIST_NAME}).execute(num_retries=3)
         return new_list['id']
 
-    def add_task_if_not_exists(self, event_title: str, event_date: str, notes: str = 'Dodano automatycznie z Librus') -> bool:
-        """Add a new task if it doesn't already exist and isn't today."""
-        event_datetime = datetime.strptime(event_date, "%Y-%m-%d")
-        today = datetime.now().date()
+    def _all_tasks(self):
+        """Yield all open tasks page by page, fetching only title and due."""
+        request = self.service.tasks().list(
+            tasklist=self.task_list_id,
+            showCompleted=False,
+            fields='items(title,due),nextPageToken',
+            maxResults=100
+        )
+        while request is not None:
+            response = request.execute(num_retries=3)
+            yield from response.get('items', [])
+            request = self.service.tasks().list_next(request, response)
+
+    def _load_existing(self):
+        """Load all existing tasks once into a set of (title, due date) pairs."""
+        if self._existing is not None:
+            return
 
-        if event_datetime.date() == today:
+        self._existing = {
+            (task['title'], (task.get('due') or '')[:10]) for task in self._all_tasks()
+        }
+
+    def add_task_if_not_exists(self, event_title: str, event_date: str, notes: str = 'Dodano automatycznie z Librus', today: Optional[date] = None) -> Optional[dict]:
+        """Build a task body if it doesn't already exist and isn't today."""
+        event_day = date.fromisoformat(event_date)
+        if today is None:
+            today = datetime.now().date()
+
+        if event_day == today:
             log_message(f"Pomijam wydarzenie z dzisiaj: {event_title}")
-            return False
+            return None
 
-        tasks = self.service.tasks().list(tasklist=self.task_list_id, showCompleted=False).execute().get('items', [])
+        self._load_existing()
 
-        for task in tasks:
-            if task['title'] == event_title and task['due'].startswith(event_date):
-                log_message(f"Już istnieje: {event_title} na {event_date}")
-                return False
+        if (event_title, event_date) in self._existing:
+            log_message(f"Już istnieje: {event_title} na {event_date}")
+            return None
 
-        due_date = event_datetime.isoformat() + "Z"
+        due_date = datetime.combine(event_day, time.min).isoformat() + "Z"
         task = {
             'title': event_title,
             'due': due_date,
             'notes': notes
         }
-        self.service.tasks().insert(tasklist=self.task_list_id, body=task).execute()
-        log_message(f"Dodano nowe: {event_title} na {event_date}")
-        return True
+        self._existing.add((event_title, event_date))
+        return task
+
+    def _on_insert(self, request_id, response, exception):
+        """Callback for a single insert inside a batch request."""
+        if exception is not None:
+            log_message(f"Błąd przy dodawaniu zadania: {str(exception)}")
+            return
+        self._inserted += 1
+        log_message(f"Dodano nowe: {response['title']} na {response['due'][:10]}")
+
+    def flush_inserts(self, tasks: List[dict]) -> int:
+        """Insert all new tasks using batch requests (max 100 per batch). Returns the number of tasks added."""
+        self._inserted = 0
+        for i in range(0, len(tasks), 100):
+            batch = self.service.new_batch_http_request()
+            for body in tasks[i:i + 100]:
+                batch.add(
+                    self.service.tasks().insert(tasklist=self.task_list_id, body=body),
+                    callback=self._on_insert
+                )
+            batch.execute()
+        return self._inserted
 
 
 class LibrusSync:
     def __init__(self):
-        load_dotenv()
         self.username = os.getenv('LIBRUS_LOGIN')
         self.password = os.getenv('LIBRUS_PASSWORD')
-        self.tasks_manager = GoogleTasksManager()
+        self.tasks_manager = None  # budowany równolegle w run_pipeline
         self.all_tasks = []
+        self.now = datetime.now()
+        self.today = self.now.date()
 
         if not self.username or not self.password:
             raise ValueError("Brak danych logowania Librus w .env!")
 
-    def process_homework(self, client: Client):
-        """Process and sync homework assignments."""
-        today = datetime.now()
+    async def process_homework_async(self, client: Client):
+        """Process and sync homework assignments, fetching details concurrently."""
+        today = self.today
         date_from = today.replace(day=1).strftime("%Y-%m-%d")
         last_day = (today.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
         date_to = last_day.strftime("%Y-%m-%d")
 
         try:
             homework_assignments = get_homework(client, date_from, date_to)
-            for homework in homework_assignments:
-                self._process_single_homework(client, homework)
+            upcoming = [hw for hw in homework_assignments if self._is_upcoming(hw)]
+
+            semaphore = asyncio.Semaphore(8)
+            details_list = await asyncio.gather(
+                *(self._fetch_detail(semaphore, client, hw) for hw in upcoming)
+            )
+
+            for homework, details in zip(upcoming, details_list):
+                notes = "\n".join(f"{k}: {v}" for k, v in details.items() if v) if details else ""
+                self.all_tasks.append({
+                    'title': f"zadanie - {homework.lesson}",
+                    'date': homework.completion_date.split()[0],
+                    'notes': notes
+                })
 
         except Exception as e:
             log_message(f"Błąd podczas przetwarzania zadań: {str(e)}")
+        finally:
+            _logger.flush()
 
-    def _process_single_homework(self, client: Client, homework: Homework):
-        """Process a single homework assignment."""
+    def _is_upcoming(self, homework: Homework) -> bool:
+        """Check whether a homework assignment is due after today."""
         completion_date = homework.completion_date.split()[0]
 
         try:
-            homework_date = datetime.strptime(completion_date, "%Y-%m-%d")
-            today = datetime.now().date()
+            homework_date = date.fromisoformat(completion_date)
+        except ValueError:
+            log_message(f"Nieprawidłowy format daty: {homework.completion_date}")
+            return False
 
-            if homework_date.date() == today:
-                log_message(f"Pomijam zadanie domowe z dzisiaj: {homework.lesson}")
-                return
+        today = self.today
 
-            if homework_date.date() < today:
-                log_message(f"Pomijam zadanie domowe z przeszłości: {homework.lesson}")
-                return
+        if homework_date == today:
+            log_message(f"Pomijam zadanie domowe z dzisiaj: {homework.lesson}")
+            return False
 
-        except ValueError:
-            log_message(f"Nieprawidłowy format daty: {homework.completion_date}")
-            return
+        if homework_date < today:
+            log_message(f"Pomijam zadanie domowe z przeszłości: {homework.lesson}")
+            return False
 
-        details = homework_detail(client, homework.href)
-        notes = "\n".join([f"{k}: {v}" for k, v in details.items() if v])
-        event_title = f"zadanie - {homework.lesson}"
+        return True
 
-        self.all_tasks.append({
-            'title': event_title,
-            'date': completion_date,
-            'notes': notes
-        })
+    async def _fetch_detail(self, semaphore: asyncio.Semaphore, client: Client, homework: Homework) -> dict:
+        """Fetch homework details in a worker thread, limited by the semaphore."""
+        async with semaphore:
+            return await asyncio.to_thread(homework_detail, client, homework.href)
 
     def process_schedule(self, client: Client):
         """Process and sync schedule events."""
-        current_date = datetime.now()
-        month = current_date.strftime("%m")
-        year = current_date.strftime("%Y")
+        today = self.today
+        month = today.strftime("%m")
+        year = today.strftime("%Y")
         schedule = get_schedule(client, month, year, include_empty=True)
 
-        for day, events in schedule.items():
-            if events:
-                self._process_day_events(events, day, month, year)
-
-    def _process_day_events(self, events: List, day: int, month: str, year: str):
-        """Process events for a single day."""
-        for event in events:
-            if not event.title:
-                continue
-
-            if not any(keyword in event.title.lower() for keyword in TEST_KEYWORDS):
-                continue
-
+        # Jedno płaskie przejście: dni z przeszłości i tytuły bez słów kluczowych
+        # odpadają na porównaniach int/regex, zanim powstanie jakikolwiek string daty
+        pairs = [
+            (day, event)
+            for day, events in schedule.items()
+            if events and int(day) >= today.day
+            for event in events
+            if event.title and _KEYWORD_RE.search(event.title)
+        ]
+
+        for day, event in pairs:
             event_date = f"{year}-{month}-{str(day).zfill(2)}"
-            if datetime.strptime(event_date, "%Y-%m-%d") < datetime.now() - timedelta(days=1):
-                continue
-
             self._add_event_task(event, event_date)
 
+        _logger.flush()
+
     def _add_event_task(self, event: any, event_date: str):
         """Add a single event as a task."""
-        notes = []
+        notes = ""
         if event.data and isinstance(event.data, dict):
-            notes = [f"{k}: {v}" for k, v in event.data.items() if v and v != "unknown"]
+            notes = "\n".join(f"{k}: {v}" for k, v in event.data.items() if v and v != "unknown")
 
         event_title = f"{event.title} - {event.subject}" if event.subject else event.title
         if event.hour and event.hour != "unknown":
@@ -209,21 +311,28 @@ class LibrusSync:
         self.all_tasks.append({
             'title': event_title,
             'date': event_date,
-            'notes': "\n".join(notes) if notes else "Brak dodatkowych informacji"
+            'notes': notes or "Brak dodatkowych informacji"
         })
 
     def process_collected_tasks(self) -> int:
         """Sort and add collected tasks in chronological order. Returns the number of tasks added."""
-        self.all_tasks.sort(key=lambda task: task['date'], reverse=True)
-        added_count = 0
+        unique = {}
         for task in self.all_tasks:
-            added = self.tasks_manager.add_task_if_not_exists(
+            unique.setdefault((task['title'], task['date']), task)
+
+        to_insert = []
+        for task in sorted(unique.values(), key=itemgetter('date'), reverse=True):
+            body = self.tasks_manager.add_task_if_not_exists(
                 task['title'],
                 task['date'],
-                notes=task['notes']
+                notes=task['notes'],
+                today=self.today
             )
-            if added:
-                added_count += 1
+            if body:
+                to_insert.append(body)
+
+        added_count = self.tasks_manager.flush_inserts(to_insert)
+        _logger.flush()
         return added_count
 
 
@@ -251,10 +360,10 @@ def send_discord_embed(title: str, description: str, color: int):
     }
 
     try:
-        response = requests.post(
+        response = _session.post(
             webhook_url,
             json=payload,
-            headers={'Content-Type': 'application/json'}
+            timeout=(3, 10)
         )
         if response.status_code == 204:
             log_message("Wysłano wiadomość na Discord.")
@@ -265,6 +374,40 @@ def send_discord_embed(title: str, description: str, color: int):
 
 
 @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
+def _librus_login(client: Client, username: str, password: str):
+    """Log into Librus, retrying only the login call on transient failures."""
+    client.get_token(username, password)
+
+
+@lru_cache(maxsize=1)
+def get_librus_client(username: str, password: str) -> Client:
+    """Return an authenticated Librus client, logging in only on first use."""
+    client = new_client()
+    _librus_login(client, username, password)
+    return client
+
+
+def _build_tasks_manager() -> GoogleTasksManager:
+    """Build the Tasks manager and prefetch the existing-task index."""
+    manager = GoogleTasksManager()
+    manager._load_existing()
+    return manager
+
+
+async def run_pipeline(sync: LibrusSync) -> int:
+    """Run the Google and Librus sides of the sync concurrently, then insert."""
+    async def fetch_librus():
+        client = await asyncio.to_thread(get_librus_client, sync.username, sync.password)
+        await asyncio.to_thread(sync.process_schedule, client)
+        await sync.process_homework_async(client)
+
+    google_task = asyncio.create_task(asyncio.to_thread(_build_tasks_manager))
+    librus_task = asyncio.create_task(fetch_librus())
+    sync.tasks_manager, _ = await asyncio.gather(google_task, librus_task)
+
+    return sync.process_collected_tasks()
+
+
 def main() -> int:
     """Main function to run the Librus sync process."""
     try:
@@ -272,14 +415,8 @@ def main() -> int:
         print(f"----------- {current_date_header} ------------")
         
         sync = LibrusSync()
-        client = new_client()
-        client.get_token(sync.username, sync.password)
 
-        sync.process_schedule(client)
-        sync.process_homework(client)
-        added_count = sync.process_collected_tasks()
-        
-        return added_count
+        return asyncio.run(run_pipeline(sync))
 
     except Exception as e:
         log_message(f"Błąd w głównej funkcji: {str(e)}")
@@ -296,6 +433,7 @@ if __name__ == "__main__":
         error_traceback = traceback.format_exc()
         log_message(f"Całkowity błąd synchronizacji:\n{error_traceback}")
         
-        # Formatowanie błędu dla Discord
-        error_msg = f"```\n{error_traceback[:1900]}\n```"  # Ograniczenie do 2000 znaków
+        # Formatowanie błędu dla Discord - przycinanie po bajtach bez rozcinania znaków UTF-8
+        safe_traceback = error_traceback.encode('utf-8')[:1900].decode('utf-8', errors='ignore')
+        error_msg = f"```\n{safe_traceback}\n```"  # Ograniczenie do 2000 znaków
         send_discord_embed("❌ Błąd Synchronizacji", error_msg, 0xFF0000)
\ No newline at end of file